@@ -0,0 +1,289 @@
+"""
+Shared scaffolding for the one-time Supabase → Cloud SQL migrations.
+
+Provides the cached Supabase client and Cloud SQL connection pool,
+keyset Supabase pagination, and COPY-based staging/upsert helpers.
+Imported by the migrate-*.py scripts in this directory; running several
+migrations in one process reuses a single client and pool.
+
+Prerequisites:
+  pip install supabase psycopg2-binary
+
+Environment variables:
+  SUPABASE_URL          - Supabase project URL
+  SUPABASE_SERVICE_KEY  - Supabase service role key (bypasses RLS)
+  CLOUD_SQL_HOST        - Cloud SQL host (or Unix socket path)
+  CLOUD_SQL_DATABASE    - Database name
+  CLOUD_SQL_USER        - Database user
+  CLOUD_SQL_PASSWORD    - Database password
+"""
+
+import functools
+import io
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from supabase import create_client
+from psycopg2.pool import ThreadedConnectionPool
+
+# --- Configuration ---
+SUPABASE_URL = os.environ["SUPABASE_URL"]
+SUPABASE_SERVICE_KEY = os.environ["SUPABASE_SERVICE_KEY"]
+
+CLOUD_SQL_HOST = os.environ["CLOUD_SQL_HOST"]
+CLOUD_SQL_DATABASE = os.environ["CLOUD_SQL_DATABASE"]
+CLOUD_SQL_USER = os.environ["CLOUD_SQL_USER"]
+CLOUD_SQL_PASSWORD = os.environ["CLOUD_SQL_PASSWORD"]
+CLOUD_SQL_MAX_CONN = 8
+
+PAGE_SIZE = 1000  # Supabase max rows per request
+BATCH_SIZE = 1000  # rows per COPY into the staging table
+WRITE_QUEUE_DEPTH = 4  # batches buffered ahead of the Cloud SQL writer
+MIGRATION_WORK_MEM = "256MB"
+
+
+@functools.lru_cache(maxsize=1)
+def get_supabase_client():
+    return create_client(SUPABASE_URL, SUPABASE_SERVICE_KEY)
+
+
+@functools.lru_cache(maxsize=1)
+def get_cloud_sql_pool():
+    return ThreadedConnectionPool(
+        minconn=1,
+        maxconn=CLOUD_SQL_MAX_CONN,
+        host=CLOUD_SQL_HOST,
+        database=CLOUD_SQL_DATABASE,
+        user=CLOUD_SQL_USER,
+        password=CLOUD_SQL_PASSWORD,
+    )
+
+
+def get_cloud_sql_conn():
+    return get_cloud_sql_pool().getconn()
+
+
+def release_cloud_sql_conn(conn):
+    """Return a connection to the pool (rolling back any open transaction)."""
+    get_cloud_sql_pool().putconn(conn)
+
+
+def postgrest_quote(value):
+    """Quote a value for use inside a PostgREST or=(...) filter."""
+    return '"' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def keyset_filter(key, last):
+    """Build an or=(...) filter selecting rows after ``last`` in ``key`` order.
+
+    For key (a, b) this is: a > last_a OR (a = last_a AND b > last_b).
+    """
+    terms = []
+    for i, col in enumerate(key):
+        conds = [f"{k}.eq.{postgrest_quote(v)}" for k, v in zip(key[:i], last[:i])]
+        conds.append(f"{col}.gt.{postgrest_quote(last[i])}")
+        terms.append(conds[0] if len(conds) == 1 else f"and({','.join(conds)})")
+    return ",".join(terms)
+
+
+def paginate(sb, table, select, key, filters=None):
+    """Yield all rows using keyset pagination (Supabase caps at 1000 per request).
+
+    Rows are ordered by the ``key`` columns, which must be selected and
+    uniquely identify a row; each page continues after the last key seen
+    instead of using OFFSET, so every page costs the same on the server.
+    Rows with a NULL key column are not returned; callers count them with
+    count_rows(..., any_null=key). The next page is requested while the
+    current one is being consumed.
+    """
+
+    def fetch_page(last):
+        query = sb.table(table).select(select)
+        for col, op, val in filters or []:
+            query = query.filter(col, op, val)
+        for col in key:
+            query = query.filter(col, "not.is", "null").order(col)
+        if last is not None:
+            query = query.or_(keyset_filter(key, last))
+        return query.limit(PAGE_SIZE).execute().data or []
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(fetch_page, None)
+        while future is not None:
+            batch = future.result()
+            future = None
+            if len(batch) == PAGE_SIZE:
+                future = executor.submit(fetch_page, [batch[-1][col] for col in key])
+            yield from batch
+
+
+def count_rows(sb, table, filters=None, any_null=()):
+    """Return the exact number of rows matching ``filters``.
+
+    With ``any_null``, only rows where at least one of those columns is
+    NULL are counted.
+    """
+    query = sb.table(table).select("*", count="exact", head=True)
+    for col, op, val in filters or []:
+        query = query.filter(col, op, val)
+    if any_null:
+        query = query.or_(",".join(f"{col}.is.null" for col in any_null))
+    return query.execute().count or 0
+
+
+def copy_escape(value):
+    """Render a value as a COPY text-format field."""
+    if value is None:
+        return r"\N"
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+def to_copy_buffer(rows):
+    """Serialize row tuples into an in-memory COPY text-format file."""
+    buf = io.StringIO()
+    for row in rows:
+        buf.write("\t".join(map(copy_escape, row)))
+        buf.write("\n")
+    buf.seek(0)
+    return buf
+
+
+def begin_migration(conn):
+    """Start the migration transaction with bulk-load session settings.
+
+    Everything up to the caller's single commit runs in this transaction.
+    """
+    conn.set_session(isolation_level="READ COMMITTED", autocommit=False)
+    cursor = conn.cursor()
+    # Re-runnable one-time load: don't wait for the WAL flush at commit
+    cursor.execute("SET LOCAL synchronous_commit = off")
+    # Keep the merge's DISTINCT ON sort and staging hash join in memory
+    cursor.execute("SET LOCAL work_mem = %s", (MIGRATION_WORK_MEM,))
+    cursor.close()
+
+
+def stage_rows(conn, copy_sql, rows):
+    """COPY rows into a staging table in BATCH_SIZE chunks.
+
+    A writer thread drains batches from a bounded queue, so Cloud SQL writes
+    overlap with the Supabase fetches producing ``rows``. Returns the number
+    of rows staged.
+    """
+    batches = queue.Queue(maxsize=WRITE_QUEUE_DEPTH)
+    errors = []
+
+    def writer():
+        cursor = None
+        try:
+            cursor = conn.cursor()
+            while True:
+                batch = batches.get()
+                if batch is None:
+                    return
+                cursor.copy_expert(copy_sql, to_copy_buffer(batch))
+        except Exception as exc:
+            errors.append(exc)
+            # Keep draining so the producer never blocks on a full queue
+            while batches.get() is not None:
+                pass
+        finally:
+            if cursor is not None:
+                cursor.close()
+
+    thread = threading.Thread(target=writer, daemon=True)
+    thread.start()
+    total = 0
+    batch = []
+    try:
+        for row in rows:
+            batch.append(row)
+            if len(batch) == BATCH_SIZE:
+                if errors:
+                    break  # the transaction is aborted; stop fetching
+                batches.put(batch)
+                total += len(batch)
+                batch = []
+                print(f"  Staged {total} records...")
+        else:
+            if batch and not errors:
+                batches.put(batch)
+                total += len(batch)
+    finally:
+        batches.put(None)
+        thread.join()
+    if errors:
+        raise errors[0]
+    return total
+
+
+def copy_upsert(conn, staging_table, target_table, records, columns, conflict_cols, update_cols):
+    """COPY records into a temp staging table and merge them into target_table.
+
+    Records are an iterable of tuples matching ``columns``. Duplicate
+    conflict keys are collapsed with the last staged occurrence winning,
+    and conflicting rows are only updated when an ``update_cols`` value
+    changed. Returns (staged, merged, changed, landed) row counts: merged
+    is the number of deduplicated rows sent to the merge, landed the number
+    of target_table rows holding one of the staged keys afterwards.
+    """
+    cols = ", ".join(columns)
+    conflict = ", ".join(conflict_cols)
+    cursor = conn.cursor()
+    # The staging table only lives until this transaction commits. It clones
+    # the target's column types, so COPY parses each field once with that
+    # type's input function (uuid, timestamptz, ...) and the merge below
+    # needs no casts.
+    cursor.execute(
+        f"""
+        CREATE TEMP TABLE {staging_table} ON COMMIT DROP AS
+        SELECT {cols} FROM {target_table} WITH NO DATA
+        """
+    )
+    cursor.execute(f"ALTER TABLE {staging_table} ADD COLUMN seq BIGSERIAL")
+    staged = stage_rows(conn, f"COPY {staging_table} ({cols}) FROM STDIN", records)
+    if not staged:
+        cursor.close()
+        return 0, 0, 0, 0
+    print(f"  Staged {staged} records via COPY")
+
+    updates = ",\n            ".join(f"{c} = EXCLUDED.{c}" for c in update_cols)
+    changed = "\n           OR ".join(
+        f"{target_table}.{c} IS DISTINCT FROM EXCLUDED.{c}" for c in update_cols
+    )
+    # ON CONFLICT cannot touch the same row twice in one statement
+    merge_select = f"""
+        SELECT DISTINCT ON ({conflict}) {cols}
+        FROM {staging_table}
+        ORDER BY {conflict}, seq DESC
+    """
+    cursor.execute(f"SELECT count(*) FROM ({merge_select}) merged")
+    merged = cursor.fetchone()[0]
+    cursor.execute(
+        f"""
+        INSERT INTO {target_table} ({cols})
+        {merge_select}
+        ON CONFLICT ({conflict})
+        DO UPDATE SET
+            {updates},
+            updated_at = NOW()
+        WHERE {changed}
+        """
+    )
+    changed_rows = cursor.rowcount
+    matches = " AND ".join(f"t.{c} = s.{c}" for c in conflict_cols)
+    cursor.execute(
+        f"""
+        SELECT count(*) FROM {target_table} t
+        WHERE EXISTS (SELECT 1 FROM {staging_table} s WHERE {matches})
+        """
+    )
+    landed = cursor.fetchone()[0]
+    cursor.close()
+    return staged, merged, changed_rows, landed
@@ -5,7 +5,8 @@ Sources:
   1. rhwb_coach_input (Season >= 14): meso_qual_score
   2. rhwb_meso_scores (Season <= 13, category='Personal'): qual
 
-Maps email_id → runner_id via runners_profile.
+Maps email_id → runner_id by joining against runners_profile inside Cloud SQL
+(session-local temp table; no emails are persisted there).
 Upserts into Cloud SQL qual_scores table.
 
 Prerequisites:
@@ -20,130 +21,250 @@ Environment variables:
   CLOUD_SQL_PASSWORD    - Database password
 """
 
-import os
+import itertools
+import re
 import sys
-from supabase import create_client
-import psycopg2
-from psycopg2.extras import execute_values
+from collections import Counter, namedtuple
 
-# --- Configuration ---
-SUPABASE_URL = os.environ["SUPABASE_URL"]
-SUPABASE_SERVICE_KEY = os.environ["SUPABASE_SERVICE_KEY"]
+from _migration_base import (
+    begin_migration,
+    count_rows,
+    get_cloud_sql_conn,
+    get_supabase_client,
+    paginate,
+    release_cloud_sql_conn,
+    stage_rows,
+)
 
-CLOUD_SQL_HOST = os.environ["CLOUD_SQL_HOST"]
-CLOUD_SQL_DATABASE = os.environ["CLOUD_SQL_DATABASE"]
-CLOUD_SQL_USER = os.environ["CLOUD_SQL_USER"]
-CLOUD_SQL_PASSWORD = os.environ["CLOUD_SQL_PASSWORD"]
+UNMAPPED_SAMPLE_SIZE = 50  # unmapped emails listed in the report
 
-BATCH_SIZE = 500
+# Legacy seasons are "Season 1" .. "Season 13"; filtered server-side (Postgres ~)
+LEGACY_SEASON_PATTERN = r"^\D*0*([0-9]|1[0-3])\D*$"
+SEASON_NUM_RE = re.compile(r"\d+")
 
+# source_table values, shared by every record rather than copied per row
+COACH_INPUT = sys.intern("rhwb_coach_input")
+MESO_SCORES = sys.intern("rhwb_meso_scores")
 
-def get_supabase_client():
-    return create_client(SUPABASE_URL, SUPABASE_SERVICE_KEY)
+QUAL_KEY_COLUMNS = ("email_id", "season", "meso")
+COACH_INPUT_FILTERS = [
+    ("meso_qual_score", "not.is", "null"),
+    ("meso_qual_score", "neq", ""),
+]
+LEGACY_FILTERS = [
+    ("category", "eq", "Personal"),
+    ("qual", "not.is", "null"),
+    ("qual", "neq", ""),
+    ("season", "match", LEGACY_SEASON_PATTERN),
+]
 
+QualRecord = namedtuple("QualRecord", "email_id season meso qual_score source_table")
 
-def get_cloud_sql_conn():
-    return psycopg2.connect(
-        host=CLOUD_SQL_HOST,
-        database=CLOUD_SQL_DATABASE,
-        user=CLOUD_SQL_USER,
-        password=CLOUD_SQL_PASSWORD,
-    )
 
+def not_null(columns):
+    return [(col, "not.is", "null") for col in columns]
 
-def fetch_all_paginated(sb, table, select, filters=None):
-    """Fetch all rows using pagination (Supabase caps at 1000 per request)."""
-    rows = []
-    offset = 0
-    page_size = 1000
-    while True:
-        query = sb.table(table).select(select).range(offset, offset + page_size - 1)
-        if filters:
-            for col, op, val in filters:
-                query = query.filter(col, op, val)
-        result = query.execute()
-        batch = result.data or []
-        rows.extend(batch)
-        if len(batch) < page_size:
-            break
-        offset += page_size
-    return rows
-
-
-def fetch_runner_id_map(sb):
-    """Build email_id → runner_id lookup from runners_profile."""
-    rows = fetch_all_paginated(sb, "runners_profile", "email_id, runner_id")
-    mapping = {r["email_id"]: r["runner_id"] for r in rows if r.get("runner_id")}
-    print(f"  Loaded {len(mapping)} runner_id mappings from runners_profile")
-    return mapping
-
-
-def fetch_coach_input_quals(sb):
-    """Fetch Season >= 14 qual scores from rhwb_coach_input."""
-    rows = fetch_all_paginated(
-        sb,
-        "rhwb_coach_input",
-        "email_id, season, meso, meso_qual_score",
-        filters=[("meso_qual_score", "not.is", "null")],
+
+def stage_runner_ids(conn, sb):
+    """Load email_id → runner_id pairs from runners_profile into Cloud SQL.
+
+    The pairs go into a session-local temp table so the email → runner_id
+    join runs inside Postgres. The table is dropped when the migration
+    commits, so no emails are persisted in Cloud SQL.
+    """
+    cursor = conn.cursor()
+    cursor.execute(
+        """
+        CREATE TEMP TABLE tmp_runner_ids (
+            email_id    TEXT NOT NULL,
+            runner_id   UUID NOT NULL
+        ) ON COMMIT DROP
+        """
     )
-    # Filter out empty strings
-    rows = [r for r in rows if r.get("meso_qual_score") and r["meso_qual_score"].strip()]
-    print(f"  Fetched {len(rows)} rows from rhwb_coach_input")
-    return rows
+    # Paged on (email_id, runner_id): one email may map to several runners
+    key = ("email_id", "runner_id")
+    rows = paginate(sb, "runners_profile", "email_id, runner_id", key=key)
+    staged = stage_rows(
+        conn,
+        "COPY tmp_runner_ids (email_id, runner_id) FROM STDIN",
+        ((r["email_id"], r["runner_id"]) for r in rows),
+    )
+    expected = count_rows(sb, "runners_profile", not_null(key))
+    if staged != expected:
+        print(f"  WARNING: Loaded {staged} runner_id mappings "
+              f"but runners_profile has {expected}.")
+        sys.exit(1)
+    # Temp tables are never auto-analyzed; give the planner real row counts
+    cursor.execute("ANALYZE tmp_runner_ids")
+    cursor.close()
+    print(f"  Loaded {staged} runner_id mappings from runners_profile")
+    return staged
 
 
-def fetch_legacy_quals(sb):
-    """Fetch Season <= 13 qual scores from rhwb_meso_scores."""
-    rows = fetch_all_paginated(
+def iter_coach_input_quals(sb, stats):
+    """Yield Season >= 14 qual scores from rhwb_coach_input."""
+    # (email_id, season, meso) isn't unique here, so page on the primary key
+    rows = paginate(
+        sb,
+        COACH_INPUT,
+        "id, email_id, season, meso, meso_qual_score",
+        key=("id",),
+        filters=COACH_INPUT_FILTERS + not_null(QUAL_KEY_COLUMNS),
+    )
+    count = 0
+    for r in rows:
+        stats["fetched"] += 1
+        # Filter out whitespace-only strings
+        if r.get("meso_qual_score") and r["meso_qual_score"].strip():
+            count += 1
+            yield r
+        else:
+            stats["filtered"] += 1
+    print(f"  Fetched {count} rows from rhwb_coach_input")
+
+
+def iter_legacy_quals(sb, stats):
+    """Yield Season <= 13 qual scores from rhwb_meso_scores."""
+    # (email_id, season, meso) isn't unique here, so page on the primary key
+    rows = paginate(
         sb,
-        "rhwb_meso_scores",
-        "email_id, season, meso, qual",
-        filters=[
-            ("category", "eq", "Personal"),
-            ("qual", "not.is", "null"),
-        ],
+        MESO_SCORES,
+        "id, email_id, season, meso, qual",
+        key=("id",),
+        filters=LEGACY_FILTERS + not_null(QUAL_KEY_COLUMNS),
     )
     # Keep only legacy seasons (<= 13) and non-empty qual
-    legacy = []
+    count = 0
     for r in rows:
-        season_str = r.get("season", "")
-        season_num = "".join(c for c in season_str if c.isdigit())
-        if season_num and int(season_num) <= 13 and r.get("qual") and r["qual"].strip():
-            legacy.append(r)
-    print(f"  Fetched {len(legacy)} legacy rows from rhwb_meso_scores")
-    return legacy
+        stats["fetched"] += 1
+        season_num = SEASON_NUM_RE.search(r.get("season") or "")
+        if season_num and int(season_num.group()) <= 13 and r.get("qual") and r["qual"].strip():
+            count += 1
+            yield r
+        else:
+            stats["filtered"] += 1
+    print(f"  Fetched {count} legacy rows from rhwb_meso_scores")
 
 
-def upsert_to_cloud_sql(conn, records):
-    """Upsert records into Cloud SQL qual_scores table."""
-    if not records:
-        print("  No records to upsert.")
-        return 0
+def count_source_rows(sb, stats):
+    """Record server-side totals for both sources, including NULL-key rows.
+
+    Rows with a NULL email_id, season or meso can't be loaded (qual_scores
+    requires them), so they are excluded from the fetch and counted here.
+    """
+    for table, filters in ((COACH_INPUT, COACH_INPUT_FILTERS), (MESO_SCORES, LEGACY_FILTERS)):
+        stats["source"] += count_rows(sb, table, filters)
+        stats["null_key"] += count_rows(sb, table, filters, any_null=QUAL_KEY_COLUMNS)
+
 
+def to_records(rows, score_col, source_table, stats):
+    """Map source rows to QualRecord tuples."""
+    for row in rows:
+        stats[source_table] += 1
+        yield QualRecord(row["email_id"], row["season"], row["meso"], row[score_col], source_table)
+
+
+def upsert_to_cloud_sql(conn, records):
+    """Upsert records into Cloud SQL qual_scores table.
+
+    Records are an iterable of QualRecord tuples; they are consumed as they
+    are produced and resolved to runner_id by joining against tmp_runner_ids
+    (see stage_runner_ids). Returns (upserted, mapped_keys, unmapped,
+    unmapped_samples): upserted is the number of deduplicated rows the merge
+    wrote or matched, mapped_keys the distinct (email_id, season, meso) keys
+    that have a runner_id. They differ if an email maps to several runners or
+    several emails to one runner.
+    """
     cursor = conn.cursor()
-    sql = """
+    # Stage rows with COPY, then merge server-side in a single statement.
+    # The staging table only lives until this transaction commits.
+    cursor.execute(
+        """
+        CREATE TEMP TABLE tmp_qual_scores (
+            seq             BIGSERIAL,
+            email_id        TEXT NOT NULL,
+            season          TEXT NOT NULL,
+            meso            TEXT NOT NULL,
+            qual_score      TEXT NOT NULL,
+            source_table    TEXT NOT NULL
+        ) ON COMMIT DROP
+        """
+    )
+    staged = stage_rows(
+        conn,
+        "COPY tmp_qual_scores (email_id, season, meso, qual_score, source_table) FROM STDIN",
+        records,
+    )
+    if not staged:
+        print("  No records to upsert.")
+        conn.rollback()
+        cursor.close()
+        return 0, 0, 0, []
+    print(f"  Staged {staged} records via COPY")
+    cursor.execute("ANALYZE tmp_qual_scores")
+
+    # Rows whose email has no runner_id are skipped by the join below
+    cursor.execute(
+        """
+        SELECT count(*) FROM tmp_qual_scores s
+        WHERE NOT EXISTS (SELECT 1 FROM tmp_runner_ids r WHERE r.email_id = s.email_id)
+        """
+    )
+    unmapped = cursor.fetchone()[0]
+    unmapped_samples = []
+    if unmapped:
+        cursor.execute(
+            """
+            SELECT DISTINCT s.email_id FROM tmp_qual_scores s
+            WHERE NOT EXISTS (SELECT 1 FROM tmp_runner_ids r WHERE r.email_id = s.email_id)
+            LIMIT %s
+            """,
+            (UNMAPPED_SAMPLE_SIZE,),
+        )
+        unmapped_samples = [row[0] for row in cursor.fetchall()]
+
+    cursor.execute(
+        """
+        SELECT count(*) FROM (
+            SELECT DISTINCT s.email_id, s.season, s.meso FROM tmp_qual_scores s
+            WHERE EXISTS (SELECT 1 FROM tmp_runner_ids r WHERE r.email_id = s.email_id)
+        ) keys
+        """
+    )
+    mapped_keys = cursor.fetchone()[0]
+
+    # Collapse duplicate keys so each qual_scores row is written once (ON
+    # CONFLICT cannot touch a row twice per statement anyway). The last
+    # staged occurrence wins; rhwb_coach_input is streamed before
+    # rhwb_meso_scores, though their season ranges never overlap.
+    merge_select = """
+        SELECT DISTINCT ON (r.runner_id, s.season, s.meso)
+            r.runner_id, s.season, s.meso, s.qual_score, s.source_table
+        FROM tmp_qual_scores s
+        JOIN tmp_runner_ids r USING (email_id)
+        ORDER BY r.runner_id, s.season, s.meso, s.seq DESC
+    """
+    cursor.execute(f"SELECT count(*) FROM ({merge_select}) merged")
+    upserted = cursor.fetchone()[0]
+    cursor.execute(
+        f"""
         INSERT INTO qual_scores (runner_id, season, meso, qual_score, source_table)
-        VALUES %s
+        {merge_select}
         ON CONFLICT (runner_id, season, meso)
         DO UPDATE SET
             qual_score   = EXCLUDED.qual_score,
             source_table = EXCLUDED.source_table,
             updated_at   = NOW()
-    """
-    total = 0
-    for i in range(0, len(records), BATCH_SIZE):
-        batch = records[i : i + BATCH_SIZE]
-        values = [
-            (r["runner_id"], r["season"], r["meso"], r["qual_score"], r["source_table"])
-            for r in batch
-        ]
-        execute_values(cursor, sql, values)
-        total += len(batch)
-        print(f"  Upserted {total}/{len(records)} records...")
+        WHERE qual_scores.qual_score IS DISTINCT FROM EXCLUDED.qual_score
+           OR qual_scores.source_table IS DISTINCT FROM EXCLUDED.source_table
+        """
+    )
+    # Unchanged rows are skipped by the DO UPDATE ... WHERE clause
+    print(f"  Merged {upserted} rows; inserted or changed {cursor.rowcount} in qual_scores...")
 
     conn.commit()
     cursor.close()
-    return total
+    return upserted, mapped_keys, unmapped, unmapped_samples
 
 
 def main():
@@ -153,82 +274,55 @@ def main():
     print("1. Connecting to Supabase...")
     sb = get_supabase_client()
 
-    # 2. Build runner_id map
-    print("2. Loading runner_id mappings...")
-    runner_map = fetch_runner_id_map(sb)
-
-    # 3. Fetch qual scores from rhwb_coach_input (Season >= 14)
-    print("3. Fetching qual scores from rhwb_coach_input...")
-    coach_input_rows = fetch_coach_input_quals(sb)
-
-    # 4. Fetch legacy qual scores from rhwb_meso_scores (Season <= 13)
-    print("4. Fetching legacy qual scores from rhwb_meso_scores...")
-    legacy_rows = fetch_legacy_quals(sb)
-
-    # 5. Map email_id → runner_id and build upsert records
-    print("5. Mapping email_id → runner_id...")
-    records = []
-    unmapped = set()
-
-    for row in coach_input_rows:
-        email = row["email_id"]
-        runner_id = runner_map.get(email)
-        if not runner_id:
-            unmapped.add(email)
-            continue
-        records.append(
-            {
-                "runner_id": runner_id,
-                "season": row["season"],
-                "meso": row["meso"],
-                "qual_score": row["meso_qual_score"],
-                "source_table": "rhwb_coach_input",
-            }
-        )
-
-    for row in legacy_rows:
-        email = row["email_id"]
-        runner_id = runner_map.get(email)
-        if not runner_id:
-            unmapped.add(email)
-            continue
-        records.append(
-            {
-                "runner_id": runner_id,
-                "season": row["season"],
-                "meso": row["meso"],
-                "qual_score": row["qual"],
-                "source_table": "rhwb_meso_scores",
-            }
-        )
-
-    print(f"  Prepared {len(records)} records for upsert")
-    if unmapped:
-        print(f"  WARNING: {len(unmapped)} email(s) had no runner_id mapping:")
-        for e in sorted(unmapped):
-            print(f"    - {e}")
-
-    # 6. Upsert into Cloud SQL
-    print("6. Connecting to Cloud SQL and upserting...")
     conn = get_cloud_sql_conn()
     try:
-        total = upsert_to_cloud_sql(conn, records)
+        begin_migration(conn)
+
+        # 2. Load runner_id mappings into Cloud SQL
+        print("2. Loading runner_id mappings into Cloud SQL...")
+        stage_runner_ids(conn, sb)
+
+        # 3. Stream qual scores from rhwb_coach_input (Season >= 14) and
+        #    rhwb_meso_scores (Season <= 13) into Cloud SQL as pages arrive,
+        #    then map email_id → runner_id and upsert server-side
+        print("3. Streaming qual scores into Cloud SQL...")
+        stats = Counter()
+        count_source_rows(sb, stats)
+        records = itertools.chain(
+            to_records(iter_coach_input_quals(sb, stats), "meso_qual_score", COACH_INPUT, stats),
+            to_records(iter_legacy_quals(sb, stats), "qual", MESO_SCORES, stats),
+        )
+        total, mapped_keys, unmapped, unmapped_samples = upsert_to_cloud_sql(conn, records)
         print(f"\n  Successfully upserted {total} records into Cloud SQL.")
     finally:
-        conn.close()
+        release_cloud_sql_conn(conn)
 
-    # 7. Verify
-    print("\n7. Verification summary:")
-    print(f"  rhwb_coach_input rows fetched:  {len(coach_input_rows)}")
-    print(f"  rhwb_meso_scores legacy fetched: {len(legacy_rows)}")
-    print(f"  Total source rows:               {len(coach_input_rows) + len(legacy_rows)}")
+    if unmapped:
+        print(f"  WARNING: {unmapped} row(s) had no runner_id mapping, e.g.:")
+        for e in unmapped_samples:
+            print(f"    - {e}")
+
+    # 4. Verify
+    source_total = stats[COACH_INPUT] + stats[MESO_SCORES]
+    print("\n4. Verification summary:")
+    print(f"  rhwb_coach_input rows fetched:  {stats[COACH_INPUT]}")
+    print(f"  rhwb_meso_scores legacy fetched: {stats[MESO_SCORES]}")
+    print(f"  Total source rows:               {source_total}")
+    print(f"  Distinct mapped keys:            {mapped_keys}")
     print(f"  Records upserted to Cloud SQL:   {total}")
-    print(f"  Unmapped emails (skipped):       {len(unmapped)}")
+    print(f"  Unmapped rows (skipped):         {unmapped}")
+    print(f"  NULL-key rows (skipped):         {stats['null_key']}")
+    print(f"  Blank/non-legacy (skipped):      {stats['filtered']}")
 
-    if total == len(records):
+    if stats["fetched"] + stats["null_key"] != stats["source"]:
+        print(f"\n  WARNING: Fetched {stats['fetched']} + {stats['null_key']} NULL-key rows "
+              f"but Supabase reports {stats['source']} source rows.")
+        sys.exit(1)
+    if total == mapped_keys:
         print("\n  Migration completed successfully.")
     else:
-        print("\n  WARNING: Upsert count does not match prepared records.")
+        print("\n  WARNING: Upsert count does not match distinct mapped keys "
+              "(duplicate email ↔ runner_id mappings in runners_profile?).")
         sys.exit(1)
 
 
@@ -15,96 +15,58 @@ Environment variables:
   CLOUD_SQL_PASSWORD    - Database password
 """
 
-import os
 import sys
-from supabase import create_client
-import psycopg2
-from psycopg2.extras import execute_values
+from collections import Counter
+
+from _migration_base import (
+    begin_migration,
+    copy_upsert,
+    count_rows,
+    get_cloud_sql_conn,
+    get_supabase_client,
+    paginate,
+    release_cloud_sql_conn,
+)
+
+COLUMNS = (
+    "message_id",
+    "runner_id",
+    "feedback",
+    "user_question",
+    "assistant_response",
+    "comment",
+    "created_at",
+)
+CONFLICT_COLUMNS = ("message_id", "runner_id")
+UPDATE_COLUMNS = ("feedback", "user_question", "assistant_response", "comment")
+
+
+def to_records(rows, stats):
+    """Map veer_feedback rows to upsert tuples in COLUMNS order."""
+    for r in rows:
+        stats["prepared"] += 1
+        yield tuple(r.get(col) for col in COLUMNS)
 
-# --- Configuration ---
-SUPABASE_URL = os.environ["SUPABASE_URL"]
-SUPABASE_SERVICE_KEY = os.environ["SUPABASE_SERVICE_KEY"]
-
-CLOUD_SQL_HOST = os.environ["CLOUD_SQL_HOST"]
-CLOUD_SQL_DATABASE = os.environ["CLOUD_SQL_DATABASE"]
-CLOUD_SQL_USER = os.environ["CLOUD_SQL_USER"]
-CLOUD_SQL_PASSWORD = os.environ["CLOUD_SQL_PASSWORD"]
-
-BATCH_SIZE = 500
-
-
-def get_supabase_client():
-    return create_client(SUPABASE_URL, SUPABASE_SERVICE_KEY)
 
+def upsert_to_cloud_sql(conn, records):
+    """Upsert records into Cloud SQL veer_feedback table.
 
-def get_cloud_sql_conn():
-    return psycopg2.connect(
-        host=CLOUD_SQL_HOST,
-        database=CLOUD_SQL_DATABASE,
-        user=CLOUD_SQL_USER,
-        password=CLOUD_SQL_PASSWORD,
+    Records are an iterable of tuples in COLUMNS order; they are consumed as
+    they are produced. Returns (merged, landed): the deduplicated rows sent
+    to the merge and the veer_feedback rows holding those keys afterwards.
+    """
+    staged, merged, changed, landed = copy_upsert(
+        conn, "tmp_veer_feedback", "veer_feedback", records,
+        COLUMNS, CONFLICT_COLUMNS, UPDATE_COLUMNS,
     )
-
-
-def fetch_all_paginated(sb, table, select, filters=None):
-    """Fetch all rows using pagination (Supabase caps at 1000 per request)."""
-    rows = []
-    offset = 0
-    page_size = 1000
-    while True:
-        query = sb.table(table).select(select).range(offset, offset + page_size - 1)
-        if filters:
-            for col, op, val in filters:
-                query = query.filter(col, op, val)
-        result = query.execute()
-        batch = result.data or []
-        rows.extend(batch)
-        if len(batch) < page_size:
-            break
-        offset += page_size
-    return rows
-
-
-def upsert_to_cloud_sql(conn, records):
-    """Upsert records into Cloud SQL veer_feedback table."""
-    if not records:
+    if not staged:
         print("  No records to upsert.")
-        return 0
-
-    cursor = conn.cursor()
-    sql = """
-        INSERT INTO veer_feedback (message_id, runner_id, feedback, user_question, assistant_response, comment, created_at)
-        VALUES %s
-        ON CONFLICT (message_id, runner_id)
-        DO UPDATE SET
-            feedback           = EXCLUDED.feedback,
-            user_question      = EXCLUDED.user_question,
-            assistant_response = EXCLUDED.assistant_response,
-            comment            = EXCLUDED.comment,
-            updated_at         = NOW()
-    """
-    total = 0
-    for i in range(0, len(records), BATCH_SIZE):
-        batch = records[i : i + BATCH_SIZE]
-        values = [
-            (
-                r["message_id"],
-                r["runner_id"],
-                r["feedback"],
-                r.get("user_question"),
-                r.get("assistant_response"),
-                r.get("comment"),
-                r.get("created_at"),
-            )
-            for r in batch
-        ]
-        execute_values(cursor, sql, values)
-        total += len(batch)
-        print(f"  Upserted {total}/{len(records)} records...")
-
+        conn.rollback()
+        return 0, 0
+    # Unchanged rows are skipped by the DO UPDATE ... WHERE clause
+    print(f"  Merged {merged} rows; inserted or changed {changed} in veer_feedback...")
     conn.commit()
-    cursor.close()
-    return total
+    return merged, landed
 
 
 def main():
@@ -114,44 +76,44 @@ def main():
     print("1. Connecting to Supabase...")
     sb = get_supabase_client()
 
-    # 2. Fetch all veer_feedback rows
-    print("2. Fetching veer_feedback rows...")
-    rows = fetch_all_paginated(
-        sb,
-        "veer_feedback",
-        "message_id, runner_id, feedback, user_question, assistant_response, comment, created_at",
-    )
-    print(f"  Fetched {len(rows)} rows from veer_feedback")
-
-    if not rows:
+    # 2. Stream veer_feedback rows into Cloud SQL as pages arrive.
+    #    Rows missing message_id or runner_id are excluded by the keyset
+    #    pagination (both are the key) and only counted.
+    print("2. Streaming veer_feedback rows into Cloud SQL...")
+    stats = Counter()
+    fetched = count_rows(sb, "veer_feedback")
+    print(f"  Fetched {fetched} rows from veer_feedback")
+    if not fetched:
         print("\n  No data to migrate.")
         return
+    stats["skipped"] = count_rows(sb, "veer_feedback", any_null=CONFLICT_COLUMNS)
+    if stats["skipped"]:
+        print(f"  WARNING: Skipped {stats['skipped']} rows with missing message_id/runner_id")
 
-    # 3. Filter out rows missing runner_id
-    records = [r for r in rows if r.get("runner_id")]
-    skipped = len(rows) - len(records)
-    if skipped:
-        print(f"  WARNING: Skipped {skipped} rows with missing runner_id")
-
-    # 4. Upsert into Cloud SQL
-    print("3. Connecting to Cloud SQL and upserting...")
+    rows = paginate(sb, "veer_feedback", ", ".join(COLUMNS), key=CONFLICT_COLUMNS)
     conn = get_cloud_sql_conn()
     try:
-        total = upsert_to_cloud_sql(conn, records)
+        begin_migration(conn)
+        total, landed = upsert_to_cloud_sql(conn, to_records(rows, stats))
         print(f"\n  Successfully upserted {total} records into Cloud SQL.")
     finally:
-        conn.close()
+        release_cloud_sql_conn(conn)
 
-    # 5. Verify
-    print("\n4. Verification summary:")
-    print(f"  Supabase rows fetched:         {len(rows)}")
+    # 3. Verify
+    print("\n3. Verification summary:")
+    print(f"  Supabase rows:                 {fetched}")
     print(f"  Records upserted to Cloud SQL: {total}")
-    print(f"  Skipped (no runner_id):        {skipped}")
+    print(f"  Duplicate keys (collapsed):    {stats['prepared'] - total}")
+    print(f"  Skipped (NULL key):            {stats['skipped']}")
 
-    if total == len(records):
+    if stats["prepared"] + stats["skipped"] != fetched:
+        print(f"\n  WARNING: Paged {stats['prepared']} + skipped {stats['skipped']} rows "
+              f"but Supabase reports {fetched}.")
+        sys.exit(1)
+    if total == landed:
         print("\n  Migration completed successfully.")
     else:
-        print("\n  WARNING: Upsert count does not match prepared records.")
+        print(f"\n  WARNING: Merged {total} records but {landed} are in veer_feedback.")
         sys.exit(1)
 
 